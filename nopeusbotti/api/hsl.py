@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
 
 import paho.mqtt.client as mqtt
 from gql import Client, gql
@@ -10,6 +11,13 @@ MQTT_BROKER_URL = "mqtt.hsl.fi"
 MQTT_BROKER_PORT = 8883
 MQTT_KEEPALIVE = 60
 
+# The query is simple enough that validating it against the schema
+# is not worth the extra introspection round-trip
+_client = Client(
+    transport=AIOHTTPTransport(url=ROUTE_GRAPHQL_URL),
+    fetch_schema_from_transport=False,
+)
+
 
 def process_position_messages(on_connect, on_message):
     client = mqtt.Client()
@@ -20,37 +28,50 @@ def process_position_messages(on_connect, on_message):
     client.loop_forever()
 
 
-def get_route_mqtt_topic(route_number: str) -> str:
-    """Get the name of the MQTT topic based on route number
+def get_route_mqtt_topics(route_numbers: Iterable[str]) -> Dict[str, str]:
+    """Get the names of the MQTT topics for multiple route numbers
 
-    The topic name is fetched from the HSL GraphQL API. If no
-    matching bus is found for the route id, this method raises
-    a ValueError.
+    All the routes are resolved with a single GraphQL query, in which
+    each route is queried under its own alias. If no matching bus is
+    found for any of the route ids, this method raises a ValueError.
     """
-    result = get_route(route_number)
+    route_numbers = tuple(route_numbers)
+    result = get_routes(route_numbers)
+    return {
+        route_number: find_route_mqtt_topic(route_number, result[f"r{i}"])
+        for i, route_number in enumerate(route_numbers)
+    }
+
 
+def find_route_mqtt_topic(route_number: str, routes: List[dict]) -> str:
     try:
-        for r in result["routes"]:
+        for r in routes:
             if r["gtfsId"].endswith(route_number):
                 route_id = r["gtfsId"].replace("HSL:", "")
-                break
-    except (KeyError, IndexError, AttributeError):
-        raise ValueError("No valid ID found for route {route}")
-
-    return f"/hfp/v2/journey/ongoing/vp/+/+/+/{route_id}/#"
-
-
-@lru_cache
-def get_route(route_number: str):
-    query = gql(
-        f"""
-        {{
-            routes(name: "{route_number}", transportModes: BUS) {{
-                gtfsId
-            }}
-        }}
-        """
+                return f"/hfp/v2/journey/ongoing/vp/+/+/+/{route_id}/#"
+    except (KeyError, TypeError, AttributeError):
+        pass
+
+    raise ValueError(f"No valid ID found for route {route_number}")
+
+
+@lru_cache(maxsize=None)
+def get_routes(route_numbers: Tuple[str, ...]):
+    query = get_routes_query(len(route_numbers))
+    variables = {f"r{i}": route_number for i, route_number in enumerate(route_numbers)}
+    return _client.execute(query, variable_values=variables)
+
+
+@lru_cache(maxsize=None)
+def get_routes_query(route_count: int):
+    """Get the aliased GraphQL query for resolving route_count routes
+
+    The route numbers are passed to the query as variables, so the query
+    is parsed only once for each number of routes.
+    """
+    variables = ", ".join(f"$r{i}: String" for i in range(route_count))
+    aliased_routes = "\n".join(
+        f"r{i}: routes(name: $r{i}, transportModes: BUS) {{ gtfsId }}"
+        for i in range(route_count)
     )
-    transport = AIOHTTPTransport(url=ROUTE_GRAPHQL_URL)
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-    return client.execute(query)
+    return gql(f"query Routes({variables}) {{\n{aliased_routes}\n}}")
@@ -1,7 +1,7 @@
 import functools
 import os
 from dataclasses import dataclass
-from typing import Optional
+from typing import BinaryIO, Optional
 
 import tweepy
 
@@ -23,7 +23,8 @@ class Credentials:
         )
 
 
-def get_client(credentials: Optional[Credentials] = None):
+@functools.lru_cache(maxsize=1)
+def get_client(credentials: Credentials):
     return tweepy.Client(
         consumer_key=credentials.api_key,
         consumer_secret=credentials.api_key_secret,
@@ -36,12 +37,13 @@ def send_tweet(
     text: str,
     media_filename: Optional[str] = None,
     credentials: Optional[Credentials] = None,
+    media_file: Optional[BinaryIO] = None,
 ):
     if credentials is None:
         credentials = Credentials.from_environment()
 
     if media_filename is not None:
-        media_ids = [upload_media(media_filename, credentials).media_id]
+        media_ids = [upload_media(media_filename, credentials, media_file).media_id]
     else:
         media_ids = None
 
@@ -56,8 +58,24 @@ def get_username(credentials: Optional[Credentials] = None):
     return get_client(credentials).get_me().data.username
 
 
-def upload_media(media_filename: str, credentials: Optional[Credentials] = None):
+@functools.lru_cache(maxsize=1)
+def get_api(credentials: Credentials):
     auth = tweepy.OAuthHandler(credentials.api_key, credentials.api_key_secret)
     auth.set_access_token(credentials.access_token, credentials.access_token_secret)
-    api = tweepy.API(auth)
-    return api.media_upload(media_filename)
+    return tweepy.API(auth)
+
+
+def upload_media(
+    media_filename: str,
+    credentials: Optional[Credentials] = None,
+    media_file: Optional[BinaryIO] = None,
+):
+    """Upload media to Twitter
+
+    If media_file is given, the media is read from it instead of the
+    file system, and media_filename is only used to infer the file type.
+    """
+    if credentials is None:
+        credentials = Credentials.from_environment()
+
+    return get_api(credentials).media_upload(media_filename, file=media_file)
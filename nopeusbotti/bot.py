@@ -1,14 +1,30 @@
-import json
+import atexit
+import collections
+import functools
 import logging
-import uuid
+import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, NamedTuple, OrderedDict, TextIO
+
+try:
+    # orjson parses the payload bytes considerably faster than json
+    import orjson as json
+except ImportError:
+    import json
 
 from nopeusbotti.api import hsl, twitter
 from nopeusbotti.data import vehicle_positions
+from nopeusbotti.plots import get_plot_file
 from nopeusbotti.plots.route import plot_route_to_file
 
+# The route name (i.e. headsign) is the 12th level of a position message topic
+ROUTE_NAME_PATTERN = re.compile(r"(?:[^/]*/){11}([^/]*)")
+
+# Coordinates in the raw payload of a position message
+COORDINATE_PATTERN = re.compile(rb'"lat":(-?\d+(?:\.\d+)?),"long":(-?\d+(?:\.\d+)?)')
+
 
 @dataclass(frozen=True)
 class Area:
@@ -19,8 +35,7 @@ class Area:
     speed_limit: float
 
 
-@dataclass(frozen=True)
-class Vehicle:
+class Vehicle(NamedTuple):
     route_number: str
     route_name: str
     operating_day: str
@@ -28,13 +43,24 @@ class Vehicle:
 
 
 class VehicleData:
+    __slots__ = ("max_timestamp", "message_count", "positions")
+
     def __init__(self):
         self.max_timestamp = 0
-        self.position_messages: List[dict] = []
+        self.message_count = 0
+
+        # Only the used fields of the messages are stored, column-wise
+        self.positions: Dict[str, list] = {
+            field: [] for field in vehicle_positions.COLUMNS
+        }
 
     def add_position_message(self, message):
-        self.max_timestamp = max(self.max_timestamp, message["tsi"])
-        self.position_messages.append(message)
+        if message["tsi"] > self.max_timestamp:
+            self.max_timestamp = message["tsi"]
+        self.message_count += 1
+
+        for field, values in self.positions.items():
+            values.append(message.get(field))
 
 
 class InvalidCoordinateError(ValueError):
@@ -49,6 +75,9 @@ class Bot:
     # Monitored vehicles with no data in this time will be dropped
     EXPIRATION_SECONDS = 60
 
+    # Maximum number of CSV files (i.e. operating days) kept open at a time
+    CSV_FILES_OPEN_MAX = 2
+
     def __init__(
         self,
         area: Area,
@@ -59,17 +88,30 @@ class Bot:
         csv_directory: Path,
     ):
         self.max_timestamp = 0
-        self.vehicles: Dict[Vehicle, VehicleData] = {}
+        # Ordered from the least to the most recently seen vehicle
+        self.vehicles: OrderedDict[Vehicle, VehicleData] = collections.OrderedDict()
         self.area = area
+
+        # The bounds are checked for every message, so skip the Area lookups
+        self.north = area.north
+        self.south = area.south
+        self.east = area.east
+        self.west = area.west
+
         self.routes = routes
         self.send_tweets = send_tweets
 
         self.plot_directory = plot_directory
         self.write_csv = write_csv
         self.csv_directory = csv_directory
+        self.csv_files: OrderedDict[Path, TextIO] = collections.OrderedDict()
+        atexit.register(self.close_csv_files)
 
         self.logger = logging.getLogger(__name__)
 
+        # A single worker keeps pyplot and the CSV appends single-threaded
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
         if self.send_tweets:
             self.twitter_credentials = twitter.Credentials.from_environment()
 
@@ -87,21 +129,25 @@ class Bot:
 
         if self.write_csv:
             self.logger.info(
-                f"Run with --store-csv: producing the data used for plots to '{self.csv_directory}'"
+                "Run with --store-csv: producing the data used for plots to '%s'",
+                self.csv_directory,
             )
             self.create_directory(self.csv_directory)
 
-        self.create_directory(self.plot_directory)
+        if not self.send_tweets:
+            self.create_directory(self.plot_directory)
 
         hsl.process_position_messages(self.on_connect, self.on_message)
 
     def on_connect(self, client, userdata, flags, rc):
-        """Subscribe to relevant topics upon MQTT connection"""
-        self.logger.info(f"Client connected (rc = {rc})")
-        for route in self.routes:
-            topic = hsl.get_route_mqtt_topic(route)
-            self.logger.info(f"Subscribing to {topic}")
-            client.subscribe(topic)
+        """Subscribe to relevant topics upon MQTT connection
+
+        All the topics are subscribed to with a single SUBSCRIBE packet.
+        """
+        self.logger.info("Client connected (rc = %s)", rc)
+        topics = list(hsl.get_route_mqtt_topics(self.routes).values())
+        self.logger.info("Subscribing to %s", ", ".join(topics))
+        client.subscribe([(topic, 0) for topic in topics])
 
     def on_message(self, client, userdata, msg):
         """Handle an incoming MQTT message
@@ -111,8 +157,12 @@ class Bot:
         outside the monitored area and handles them correspondingly.
         """
         try:
+            if not self.vehicles and self.is_payload_outside_area(msg.payload):
+                return
+
             message = json.loads(msg.payload)["VP"]
-            self.max_timestamp = max(self.max_timestamp, message["tsi"])
+            if message["tsi"] > self.max_timestamp:
+                self.max_timestamp = message["tsi"]
             key = self.get_vehicle_key(msg.topic, message)
 
             if self.is_within_area(message):
@@ -123,77 +173,121 @@ class Bot:
             self.remove_expired_vehicles()
 
         except InvalidCoordinateError:
-            self.logger.debug(f"Invalid coordinates from {key} in {message}, ignoring")
+            self.logger.debug(
+                "Invalid coordinates from %s in %s, ignoring", key, message
+            )
 
         except Exception as e:
             self.logger.exception(e)
 
     def handle_vehicle_within_area(self, vehicle_key: Vehicle, message: dict):
         """Store a message from a vehicle inside the monitored area"""
-        if not vehicle_key in self.vehicles:
-            self.logger.info(f"{vehicle_key} has entered the monitored area")
-            self.vehicles[vehicle_key] = VehicleData()
+        vehicle = self.vehicles.get(vehicle_key)
+
+        if vehicle is None:
+            self.logger.info("%s has entered the monitored area", vehicle_key)
+            vehicle = self.vehicles[vehicle_key] = VehicleData()
+        else:
+            self.vehicles.move_to_end(vehicle_key)
 
-        self.vehicles[vehicle_key].add_position_message(message)
+        vehicle.add_position_message(message)
 
     def handle_vehicle_outside_area(self, vehicle_key: Vehicle):
         """Handle a message from a vehicle outside the monitored area
 
         This method only does something when the vehicle has just
         exited the monitored area, so a majority of the messages are
-        simply ignored. In the former case we generate all the relevant
-        plots, tweets and files from the data and remove the vehicle
-        from the monitored vehicles.
+        simply ignored. In the former case we remove the vehicle from
+        the monitored vehicles and schedule generating all the relevant
+        plots, tweets and files from its data in Bot.publish_route.
         """
         if vehicle_key not in self.vehicles:
             return
 
-        route_name = vehicle_key.route_name
-        position_messages = self.vehicles.pop(vehicle_key).position_messages
-        route_data = vehicle_positions.messages_to_dataframe(position_messages)
+        vehicle = self.vehicles.pop(vehicle_key)
 
-        if len(position_messages) <= Bot.MESSAGE_COUNT_MIN:
+        if vehicle.message_count <= Bot.MESSAGE_COUNT_MIN:
             raise ValueError(
-                f"{vehicle_key} has only {len(position_messages)} data points"
+                f"{vehicle_key} has only {vehicle.message_count} data points"
             )
 
-        self.logger.info(f"{vehicle_key} has left the area, plotting route")
-        plot_filename = self.plot_directory / (str(uuid.uuid4()) + ".png")
-        self.logger.info(f"Saving plot to {plot_filename}")
+        self.logger.info("%s has left the area, plotting route", vehicle_key)
+        self.executor.submit(self.publish_route, vehicle_key, vehicle.positions)
+
+    def publish_route(self, vehicle_key: Vehicle, positions: Dict[str, list]):
+        """Plot, tweet and store the route of a vehicle that has left the area
+
+        This method is run in Bot.executor, so that plotting and the
+        Twitter API requests do not block the MQTT network loop.
+        """
+        try:
+            self.plot_and_send_route(vehicle_key, positions)
+        except Exception as e:
+            self.logger.exception(e)
+
+    def plot_and_send_route(self, vehicle_key: Vehicle, positions: Dict[str, list]):
+        route_data = vehicle_positions.positions_to_dataframe(positions)
+
+        plot_file = get_plot_file(self.plot_directory, store=not self.send_tweets)
+        if not self.send_tweets:
+            self.logger.info("Saving plot to %s", plot_file)
+
         title = plot_route_to_file(
-            route_data, route_name, self.area.speed_limit, plot_filename
+            route_data, vehicle_key.route_name, self.area, plot_file
         )
 
         if self.send_tweets:
-            self.logger.info(f"Sending {plot_filename} to Twitter")
+            self.logger.info("Sending the plot of %s to Twitter", vehicle_key)
+            plot_file.seek(0)
             response = twitter.send_tweet(
-                title, plot_filename, self.twitter_credentials
+                title, "route.png", self.twitter_credentials, media_file=plot_file
             )
             route_data = route_data.assign(tweet_id=response.data["id"])
-            self.remove_file(plot_filename)
 
         if self.write_csv:
-            csv_filename = self.csv_directory / (vehicle_key.operating_day + ".csv")
-            self.logger.info(f"Saving data to {csv_filename}")
-            vehicle_positions.write_to_csv(route_data, csv_filename)
+            csv_file = self.get_csv_file(vehicle_key.operating_day)
+            self.logger.info("Saving data to %s", csv_file.name)
+            vehicle_positions.write_to_csv(route_data, csv_file)
 
     def get_vehicle_key(self, topic: str, message: dict) -> Vehicle:
         route_name = self.get_route_name(topic)
         return Vehicle(message["desi"], route_name, message["oday"], message["start"])
 
-    def get_route_name(self, mqtt_topic: str) -> str:
-        return mqtt_topic.split("/")[11]
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def get_route_name(mqtt_topic: str) -> str:
+        # A vehicle keeps publishing to the same topic until its next stop
+        # or geohash changes, so most of the topics have been seen before
+        return ROUTE_NAME_PATTERN.match(mqtt_topic)[1]
 
     def is_within_area(self, message: dict):
-        try:
-            return (
-                self.area.south <= message["lat"] <= self.area.north
-                and self.area.west <= message["long"] <= self.area.east
-            )
-        except TypeError:
-            # Lat / long coordinates sometimes null
+        lat = message["lat"]
+        long = message["long"]
+
+        # Lat / long coordinates sometimes null
+        if lat is None or long is None:
             raise InvalidCoordinateError
 
+        return self.is_within_bounds(lat, long)
+
+    def is_payload_outside_area(self, payload: bytes) -> bool:
+        """Check from a raw message payload whether it is outside the area
+
+        Parsing the JSON is the most expensive part of handling a message,
+        and while no vehicles are monitored, the messages from outside the
+        area can be ignored altogether. The coordinates are therefore first
+        looked up from the payload with a regular expression. If they are
+        not found (e.g. they are null), the message is parsed normally.
+        """
+        match = COORDINATE_PATTERN.search(payload)
+        if match is None:
+            return False
+
+        return not self.is_within_bounds(float(match[1]), float(match[2]))
+
+    def is_within_bounds(self, lat: float, long: float) -> bool:
+        return self.south <= lat <= self.north and self.west <= long <= self.east
+
     def remove_expired_vehicles(self):
         """Remove vehicles with no data within Bot.EXPIRATION_SECONDS
 
@@ -206,19 +300,44 @@ class Bot:
         from each vehicle to the most recent timestamp of all vehicles. This
         way we do not have to care about the system clock or any possible
         delays from the MQTT broker.
+
+        As Bot.vehicles is ordered by the time the vehicles were last seen,
+        only the vehicles from its beginning have to be checked.
         """
-        for key, vehicle in self.vehicles.items():
-            if self.is_expired(vehicle):
-                self.logger.warn(f"Dropping expired data from {key}")
-                self.vehicles.pop(key)
+        while self.vehicles:
+            key, vehicle = next(iter(self.vehicles.items()))
+            if not self.is_expired(vehicle):
+                break
+
+            self.logger.warning("Dropping expired data from %s", key)
+            self.vehicles.pop(key)
 
     def is_expired(self, vehicle: VehicleData) -> bool:
         return self.max_timestamp - vehicle.max_timestamp >= Bot.EXPIRATION_SECONDS
 
+    def get_csv_file(self, operating_day: str) -> TextIO:
+        """Get the CSV file of an operating day, opening it if needed
+
+        The files are kept open instead of reopening them for every route.
+        A route from the previous operating day may still finish after
+        the next one has started, so a couple of the most recently opened
+        files are kept open, and older ones are closed.
+        """
+        path = self.csv_directory / (operating_day + ".csv")
+
+        if path not in self.csv_files:
+            self.logger.info("Opening %s", path)
+            self.csv_files[path] = open(path, "a", newline="")
+
+            while len(self.csv_files) > Bot.CSV_FILES_OPEN_MAX:
+                self.csv_files.popitem(last=False)[1].close()
+
+        return self.csv_files[path]
+
+    def close_csv_files(self):
+        while self.csv_files:
+            self.csv_files.popitem()[1].close()
+
     def create_directory(self, directory: Path):
-        self.logger.info(f"Creating directory {directory}")
+        self.logger.info("Creating directory %s", directory)
         Path(directory).mkdir(parents=True, exist_ok=True)
-
-    def remove_file(self, file_path: Path):
-        self.logger.info(f"Removing file {file_path}")
-        file_path.unlink()
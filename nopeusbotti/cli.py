@@ -2,21 +2,51 @@ import logging
 from pathlib import Path
 
 import click
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas as pd
-from gql.transport.aiohttp import log as gql_logger
-
-from nopeusbotti.bot import Area, Bot
-from nopeusbotti.statistics import generate_statistics
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
 )
-gql_logger.setLevel(logging.WARNING)
 
-matplotlib.use("Agg")
-plt.style.use("seaborn-darkgrid")
+
+def setup_plotting():
+    """Configure Matplotlib for producing the figures
+
+    Matplotlib, pandas and the plotting modules are slow to import, so they
+    are only imported by the commands themselves, i.e. not for --help or
+    invalid arguments.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    import matplotlib.pyplot as plt
+
+    plt.style.use("seaborn-darkgrid")
+
+
+# The options shared by both of the commands
+SPEED_LIMIT_OPTION = click.option(
+    "--speed-limit",
+    help="Speed limit withing the monitored area",
+    type=float,
+    required=True,
+)
+NO_TWEETS_OPTION = click.option(
+    "--no-tweets",
+    help="If set, do not send any tweets, only produce the figures (for testing purposes).",
+    is_flag=True,
+    default=False,
+)
+PLOT_DIRECTORY_OPTION = click.option(
+    "--plot-directory",
+    help="The directory for storing the plotted figures if --no-tweets is specified. Otherwise the figures are uploaded to Twitter without storing them.",
+    default="plots",
+)
+CSV_DIRECTORY_OPTION = click.option(
+    "--csv-directory",
+    help="The directory for storing the data if --store-csv is specified",
+    default="data",
+)
 
 
 @click.command()
@@ -44,40 +74,22 @@ plt.style.use("seaborn-darkgrid")
     type=float,
     required=True,
 )
-@click.option(
-    "--speed-limit",
-    help="Speed limit withing the monitored area",
-    type=float,
-    required=True,
-)
+@SPEED_LIMIT_OPTION
 @click.option(
     "--route",
     help="The routes to track. This option can be repeated as many times as needed.",
     multiple=True,
     required=True,
 )
-@click.option(
-    "--no-tweets",
-    help="If set, do not send any tweets, only produce the figures (for testing purposes).",
-    is_flag=True,
-    default=False,
-)
-@click.option(
-    "--plot-directory",
-    help="The directory for storing the plotted figures. Unless --no-tweets is specified, the figures are only stored here temporarily before publishing to twitter.",
-    default="plots",
-)
+@NO_TWEETS_OPTION
+@PLOT_DIRECTORY_OPTION
 @click.option(
     "--write-csv",
     help="If set, the data used to draw each plot will be written in the specified directory (--csv-directory)",
     is_flag=True,
     default=False,
 )
-@click.option(
-    "--csv-directory",
-    help="The directory for storing the data if --store-csv is specified",
-    default="data",
-)
+@CSV_DIRECTORY_OPTION
 def nopeusbotti(
     north,
     south,
@@ -90,6 +102,13 @@ def nopeusbotti(
     write_csv,
     csv_directory,
 ):
+    from gql.transport.aiohttp import log as gql_logger
+
+    gql_logger.setLevel(logging.WARNING)
+    setup_plotting()
+
+    from nopeusbotti.bot import Area, Bot
+
     bot = Bot(
         area=Area(north, south, east, west, speed_limit),
         routes=route,
@@ -102,28 +121,10 @@ def nopeusbotti(
 
 
 @click.command()
-@click.option(
-    "--speed-limit",
-    help="Speed limit withing the monitored area",
-    type=float,
-    required=True,
-)
-@click.option(
-    "--plot-directory",
-    help="The directory for storing the plotted figures. Unless --no-tweets is specified, the figures are only stored here temporarily before publishing to twitter.",
-    default="plots",
-)
-@click.option(
-    "--no-tweets",
-    help="If set, do not send any tweets, only produce the figures (for testing purposes).",
-    is_flag=True,
-    default=False,
-)
-@click.option(
-    "--csv-directory",
-    help="The directory for storing the data if --store-csv is specified",
-    default="data",
-)
+@SPEED_LIMIT_OPTION
+@PLOT_DIRECTORY_OPTION
+@NO_TWEETS_OPTION
+@CSV_DIRECTORY_OPTION
 @click.option(
     "--start-date",
     help="The start time for the statistics producer in format YYYY-MM-DD (defaults to last week's Monday)",
@@ -142,6 +143,12 @@ def nopeusbotti_statistics(
     start_date,
     end_date,
 ):
+    setup_plotting()
+
+    import pandas as pd
+
+    from nopeusbotti.statistics import generate_statistics
+
     generate_statistics(
         speed_limit,
         no_tweets,
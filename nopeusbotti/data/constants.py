@@ -1 +1,4 @@
 SPEEDING_THRESHOLD = 4
+
+# Timezone of the plotted and stored timestamps
+TIMEZONE = "Europe/Helsinki"
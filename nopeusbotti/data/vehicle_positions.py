@@ -1,50 +1,109 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, TextIO
 
-import geopandas as gpd
 import pandas as pd
+from pandas.api.types import union_categoricals
 
+from nopeusbotti.data import constants
 
-def messages_to_dataframe(position_messages: List[dict]) -> gpd.GeoDataFrame:
-    df = pd.DataFrame(position_messages)
-
-    columns = {
-        "desi": "route_number",
-        "dir": "direction",
-        "oper": "operator",
-        "veh": "vehicle_number",
-        "tst": "time",
-        "spd": "speed",
-        "hdg": "heading_direction",
-        "lat": "lat",
-        "long": "long",
-        "acc": "acceleration",
-        "dl": "schedule_offset",
-        "odo": "odometer_reading",
-        "drst": "door_status",
-        "oday": "operating_day",
-        "start": "start_time",
-        "stop": "stop",
-    }
-
-    df = df[columns.keys()].rename(columns=columns)
-    df.loc[:, "time"] = pd.to_datetime(df.time).dt.tz_convert("EET")
-    df.loc[:, "speed"] *= 3.6
-
-    df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.long, df.lat))
-    df.crs = "EPSG:4326"
-
-    return df.set_index("time").sort_index()
-
-
-def write_to_csv(df: gpd.GeoDataFrame, path: Path):
-    df.drop("geometry", axis=1).to_csv(path, mode="a", header=not path.exists())
-
-
-def read_from_csv(*paths: Path):
-    df = pd.concat(pd.read_csv(path) for path in paths)
-    df.loc[:, "time"] = pd.to_datetime(df.time)
-    df.loc[:, "route_number"] = df.route_number.astype(str)
-    df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.long, df.lat))
-    df.crs = "EPSG:4326"
-    return df.set_index("time").sort_index()
+# The stored fields of the position messages and their column names
+COLUMNS = {
+    "desi": "route_number",
+    "dir": "direction",
+    "oper": "operator",
+    "veh": "vehicle_number",
+    "tst": "time",
+    "spd": "speed",
+    "hdg": "heading_direction",
+    "lat": "lat",
+    "long": "long",
+    "acc": "acceleration",
+    "dl": "schedule_offset",
+    "odo": "odometer_reading",
+    "drst": "door_status",
+    "oday": "operating_day",
+    "start": "start_time",
+    "stop": "stop",
+}
+
+# The columns read as categoricals, i.e. the keys of the trips
+CATEGORICAL_COLUMNS = ["route_number", "direction", "operating_day", "start_time"]
+
+
+def positions_to_dataframe(positions: Dict[str, list]) -> pd.DataFrame:
+    """Convert column-wise stored position message fields to a DataFrame
+
+    The positions map each field in COLUMNS to the list of its values.
+    """
+    df = pd.DataFrame({column: positions[field] for field, column in COLUMNS.items()})
+
+    # Speeds are reported in m/s
+    df["speed"] = df.speed.to_numpy(dtype=float) * 3.6
+    df.index = to_local_time(df.pop("time"))
+
+    # The messages from a single vehicle practically always arrive in order
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
+    return df
+
+
+def write_to_csv(df: pd.DataFrame, file: TextIO):
+    df.to_csv(file, header=file.tell() == 0)
+    file.flush()
+
+
+def read_from_csv(*paths: Path, columns: Optional[List[str]] = None):
+    """Read the stored position data from CSV files
+
+    If columns is given, only those columns (which must include the time)
+    are read from the files.
+    """
+    dtype = {column: "category" for column in CATEGORICAL_COLUMNS}
+    dtype["speed"] = "float32"
+    read_csv_file = functools.partial(pd.read_csv, usecols=columns, dtype=dtype)
+
+    # The C parser releases the GIL, so the files are parsed in parallel
+    with ThreadPoolExecutor() as executor:
+        dfs = list(executor.map(read_csv_file, paths))
+
+    df = pd.concat(unify_categories(dfs), ignore_index=True)
+
+    df.index = to_local_time(df.pop("time"))
+
+    # The routes are appended to the files as they finish, so they may overlap
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
+    return df
+
+
+def unify_categories(dfs: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """Set the same categories to the categorical columns of the DataFrames
+
+    Otherwise pd.concat would convert the columns to objects.
+    """
+    for column in CATEGORICAL_COLUMNS:
+        if column not in dfs[0]:
+            continue
+
+        categories = union_categoricals(
+            [df[column] for df in dfs], sort_categories=True
+        ).categories
+        for df in dfs:
+            df[column] = df[column].cat.set_categories(categories)
+
+    return dfs
+
+
+def to_local_time(time: pd.Series) -> pd.DatetimeIndex:
+    """Parse timestamps to the local time zone
+
+    The timestamps are parsed as UTC, as the offset of the local times
+    changes with daylight saving time.
+    """
+    return pd.DatetimeIndex(pd.to_datetime(time, utc=True)).tz_convert(
+        constants.TIMEZONE
+    )
@@ -0,0 +1,15 @@
+import io
+import secrets
+from pathlib import Path
+from typing import BinaryIO, Union
+
+
+def get_plot_file(plot_directory: Path, store: bool) -> Union[Path, BinaryIO]:
+    """Get a randomly named file in plot_directory, or an in-memory file
+
+    A plot that is only uploaded does not need to be stored on disk,
+    so unless store is set, the plot is written to memory instead.
+    """
+    if store:
+        return plot_directory / (secrets.token_hex(8) + ".png")
+    return io.BytesIO()
@@ -1,21 +1,37 @@
+import functools
+
 import contextily as cx
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
 
 from nopeusbotti.data import constants
 
+# Radius of the spherical earth used by Web Mercator
+EARTH_RADIUS = 6378137.0
+
+BASEMAP_SOURCE = cx.providers.OpenStreetMap.Mapnik
+BASEMAP_ZOOM = 17
+
+# The zoom of the cached basemap is lowered until it has at most this many tiles
+BASEMAP_TILES_MAX = 100
 
-def plot_route_to_file(route_data, route_name, speed_limit, path):
-    plot_route_speed_and_map(route_data, speed_limit)
+# Margin around the route on the map, relative to the extent of the route
+MAP_MARGIN = 0.15
+
+
+def plot_route_to_file(route_data, route_name, area, path):
+    speed_limit = area.speed_limit
+    fig = plot_route_speed_and_map(route_data, area)
 
     sample = route_data.iloc[0]
     route_number = sample.route_number
     time = f"{sample.operating_day} {sample.start_time}"
 
-    speeding = (route_data.speed - speed_limit).max()
+    speeding = route_data.speed.max() - speed_limit
     speeding_proportional = speeding / speed_limit
 
-    title = title = f"Linja {route_number} ({route_name}) - lähtö {time}. "
+    title = f"Linja {route_number} ({route_name}) - lähtö {time}. "
 
     if speeding >= constants.SPEEDING_THRESHOLD:
         title += f"Suurin ylinopeus {speeding:.1f} km/h ({100 * speeding_proportional:.0f}%)."
@@ -24,74 +40,147 @@ def plot_route_to_file(route_data, route_name, speed_limit, path):
     else:
         title += "Ei ylinopeutta."
 
-    plt.suptitle(title, y=0.9)
-    plt.savefig(path)
-    plt.close()
+    fig.suptitle(title, y=0.9)
+    fig.savefig(path)
 
     return title
 
 
-def plot_route_speed_and_map(route_data, speed_limit):
+@functools.lru_cache(maxsize=1)
+def get_route_figure():
+    """Create the figure used for all the route plots
+
+    Instead of creating a new figure for each route, the same figure is
+    reused and only its axes are cleared in between the plots. The figure
+    is created on the first plot, so that any style set before that
+    applies to it.
+    """
     w, h = matplotlib.figure.figaspect(9 / 16)
-    _, (ax1, ax2) = plt.subplots(
+    fig, (ax1, ax2) = plt.subplots(
         1, 2, figsize=(1.25 * w, 1.25 * h), gridspec_kw={"width_ratios": [2, 1]}
     )
     wspace = 0.5 / 16
     padding_horizontal = 3 / 16 - wspace
     padding_vertical = 4 / 9
-    plt.subplots_adjust(
+    fig.subplots_adjust(
         left=3 / 4 * padding_horizontal / 2,
         right=1 - 1 / 4 * padding_horizontal / 2,
         top=1 - padding_vertical / 2,
         bottom=padding_vertical / 2,
         wspace=wspace,
     )
-    plot_route_speed(route_data, speed_limit, ax1)
-    plot_route_map(route_data, speed_limit, ax2)
+    return fig, ax1, ax2
+
+
+def plot_route_speed_and_map(route_data, area):
+    fig, ax1, ax2 = get_route_figure()
+    ax1.clear()
+    ax2.clear()
+    plot_route_speed(route_data, area.speed_limit, ax1)
+    plot_route_map(route_data, area, ax2)
+    return fig
 
 
 def plot_route_speed(route_data, speed_limit, ax):
-    route_data.speed.plot(style="o-", ax=ax)
-    route_data.speed[route_data.speed > speed_limit].plot(style="o", color="red", ax=ax)
+    # Matplotlib shows the times in UTC, so the local times are plotted as naive
+    time = route_data.index.tz_localize(None).to_numpy()
+    speed = route_data.speed.to_numpy()
+    speeding = speed > speed_limit
+
+    ax.plot(time, speed, "-", color="C0")
+    ax.scatter(time, speed, c=np.where(speeding, "red", "C0"), s=36, zorder=2)
     ax.set_ylim(bottom=0, top=max([speed_limit + 10, route_data.speed.max() + 5]))
     ax.set_xlabel("Aika")
     ax.set_ylabel("Nopeus (km/h)")
-    ax.hlines(
-        speed_limit,
-        route_data.index.min(),
-        route_data.index.max(),
-        color="red",
-        linestyle="dashed",
-    )
+    ax.hlines(speed_limit, time[0], time[-1], color="red", linestyle="dashed")
 
 
-def plot_route_map(route_data, speed_limit, ax):
+def plot_route_map(route_data, area, ax):
+    speed_limit = area.speed_limit
     ax.set_axis_off()
 
-    x = route_data.to_crs(epsg=3857).geometry.x
-    y = route_data.to_crs(epsg=3857).geometry.y
+    x, y = to_web_mercator(route_data.long.to_numpy(), route_data.lat.to_numpy())
+
+    speeding = route_data.speed.to_numpy() > speed_limit
 
     ax.plot(x, y, "o-", ms=4)
-    ax.plot(
-        x[route_data.speed > speed_limit],
-        y[route_data.speed > speed_limit],
-        "ro",
-        ms=4,
-    )
+    ax.plot(x[speeding], y[speeding], "ro", ms=4)
 
-    arrow_x = x.iloc[-1]
-    arrow_y = y.iloc[-1]
-    dx = x.iloc[-1] - x.iloc[-2]
-    dy = y.iloc[-1] - y.iloc[-2]
+    (x0, x1), (y0, y1) = x[-2:], y[-2:]
+    dx = x1 - x0
+    dy = y1 - y0
     ax.arrow(
-        arrow_x + dx / 2,
-        arrow_y + dy / 2,
+        x1 + dx / 2,
+        y1 + dy / 2,
         dx,
         dy,
         width=3,
-        color="red" if route_data.iloc[-1].speed > speed_limit else "#1f77b4",
+        color="red" if speeding[-1] else "#1f77b4",
     )
 
     ax.set_aspect("equal", "datalim")
-    ax.margins(0.15)
-    cx.add_basemap(ax, source=cx.providers.OpenStreetMap.Mapnik, zoom=17)
+    ax.margins(MAP_MARGIN)
+    add_basemap(ax, area)
+
+
+def add_basemap(ax, area):
+    """Add the basemap of the monitored area to the axes
+
+    This does the same as contextily.add_basemap, except that the map
+    image is normally fetched only once for the whole area instead of
+    separately for the extent of each route. If the cached image does not
+    cover the axes, the basemap is fetched for the axes as before.
+    """
+    # Apply the equal aspect ratio, which adjusts the axis limits
+    ax.apply_aspect()
+    xmin, xmax, ymin, ymax = ax.axis()
+
+    box = ax.get_window_extent()
+    box_aspect = round(box.height / box.width, 3)
+    image, extent = get_basemap(
+        area.west, area.south, area.east, area.north, box_aspect
+    )
+    left, right, bottom, top = extent
+
+    if not (left <= xmin and xmax <= right and bottom <= ymin and ymax <= top):
+        cx.add_basemap(ax, source=BASEMAP_SOURCE, zoom=BASEMAP_ZOOM)
+        return
+
+    ax.imshow(image, extent=extent, interpolation="bilinear")
+    ax.axis((xmin, xmax, ymin, ymax))
+
+
+@functools.lru_cache(maxsize=32)
+def get_basemap(west, south, east, north, box_aspect):
+    """Fetch the basemap image and its Web Mercator extent for an area
+
+    The map of a route within the area is centered on the route and padded
+    by MAP_MARGIN of its extent, and then widened or heightened to the
+    aspect ratio (height / width) of the axes box. The fetched extent is
+    padded just enough to cover all such maps.
+    """
+    (x0, x1), (y0, y1) = to_web_mercator(
+        np.array([west, east]), np.array([south, north])
+    )
+    width = x1 - x0
+    height = y1 - y0
+    padding_x = max(MAP_MARGIN * width, (0.5 + MAP_MARGIN) * height / box_aspect)
+    padding_y = max(MAP_MARGIN * height, (0.5 + MAP_MARGIN) * width * box_aspect)
+    bounds = (x0 - padding_x, y0 - padding_y, x1 + padding_x, y1 + padding_y)
+
+    zoom = BASEMAP_ZOOM
+    while zoom > 0 and cx.howmany(*bounds, zoom, verbose=False) > BASEMAP_TILES_MAX:
+        zoom -= 1
+
+    return cx.bounds2img(*bounds, zoom=zoom, source=BASEMAP_SOURCE)
+
+
+def to_web_mercator(long, lat):
+    """Project WGS84 coordinates to Web Mercator (EPSG:3857)
+
+    The projection of the basemap tiles has a closed form, so there is
+    no need to reproject the whole GeoDataFrame with pyproj.
+    """
+    x = EARTH_RADIUS * np.radians(long)
+    y = EARTH_RADIUS * np.arcsinh(np.tan(np.radians(lat)))
+    return x, y
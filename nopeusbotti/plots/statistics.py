@@ -1,21 +1,31 @@
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import seaborn as sns
 
 from nopeusbotti.data import constants
 
 ALPHA = 0.7
 
+DPI = 80
+
+FIGURE_SIZE = 2.5 * mpl.figure.figaspect(9 / 16)
+
+# Simplify the drawn paths as much as is invisible, and draw them in chunks
+RC_PARAMS = {"path.simplify_threshold": 1.0, "agg.path.chunksize": 10000}
+
 
 def plot_statistics_to_file(df, speed_limit, start_time, end_time, path):
     max_speeds = get_max_speeds(df, speed_limit)
     hourly_counts = get_hourly_speeding_counts(max_speeds)
-    plot_statistics(max_speeds, hourly_counts, speed_limit)
 
-    speeding_proportion = hourly_counts.sum()[True] / hourly_counts.sum().sum()
+    totals = hourly_counts.sum()
+    speeding_proportion = totals[True] / totals.sum()
     max_speed = max_speeds.max_speed.max()
-    most_moderate_route = max_speeds.groupby(level=0).speeding.mean().idxmin()
+    most_moderate_route = (
+        max_speeds.groupby(level=0, observed=True).speeding.mean().idxmin()
+    )
     date_format = "%d.%m.%Y"
     title = (
         f"Tilasot aikaväliltä {start_time.strftime(date_format)}–{end_time.strftime(date_format)}. "
@@ -23,9 +33,11 @@ def plot_statistics_to_file(df, speed_limit, start_time, end_time, path):
         f"Keskimäärin maltillisimmin ajoivat linjan {most_moderate_route} bussit."
     )
 
-    plt.suptitle(title)
-    plt.savefig(path)
-    plt.close()
+    with mpl.rc_context(RC_PARAMS):
+        plot_statistics(max_speeds, hourly_counts, speed_limit)
+        plt.suptitle(title)
+        plt.savefig(path, dpi=DPI)
+        plt.close()
 
     return title
 
@@ -40,14 +52,19 @@ def plot_hourly_counts(hourly_counts, ax):
         return label
 
     ax.yaxis.set_major_formatter(no_negative_values)
-    ax.stackplot(
-        hourly_counts.index, hourly_counts[True], colors=[speeding_color], alpha=ALPHA
+    ax.fill_between(
+        hourly_counts.index,
+        hourly_counts[True].to_numpy(),
+        color=speeding_color,
+        alpha=ALPHA,
+        linewidth=0,
     )
-    ax.stackplot(
+    ax.fill_between(
         hourly_counts.index,
-        -hourly_counts[False],
-        colors=[no_speeding_color],
+        -hourly_counts[False].to_numpy(),
+        color=no_speeding_color,
         alpha=ALPHA,
+        linewidth=0,
     )
 
     ax.plot([], [], speeding_color, label="Ylinopeus >= 4 km/h")
@@ -62,18 +79,18 @@ def plot_hourly_counts(hourly_counts, ax):
     ax.set_title("Nopeusrajoituksen noudattaminen aikavälillä")
 
 
-def plot_max_speeds(max_speeds, speed_limit, ax, by):
+def plot_max_speeds(max_speeds, speed_limit, ax, groups):
     sns.boxplot(
-        data=max_speeds.reset_index()[[by, "max_speed"]].sort_values(by),
-        y="max_speed",
-        x=by,
+        x=groups,
+        y=max_speeds.max_speed.to_numpy(),
+        order=np.unique(groups),
         flierprops={"marker": "x"},
         ax=ax,
     )
 
-    for patch in ax.artists:
-        fc = patch.get_facecolor()
-        patch.set_facecolor(mpl.colors.to_rgba(fc, ALPHA))
+    # Only the faces of the boxes are made transparent, not their outlines
+    for patch in ax.patches:
+        patch.set_facecolor(mpl.colors.to_rgba(patch.get_facecolor(), ALPHA))
 
     ax.set_ylabel("Nopeus (km/h)")
     xlim = ax.get_xlim()
@@ -83,22 +100,23 @@ def plot_max_speeds(max_speeds, speed_limit, ax, by):
 
 
 def plot_max_speeds_by_route(max_speeds, speed_limit, ax):
-    plot_max_speeds(max_speeds, speed_limit, ax, "route_number")
+    routes = max_speeds.index.get_level_values("route_number")
+    plot_max_speeds(max_speeds, speed_limit, ax, routes)
     ax.set_xlabel("Linja")
     ax.set_title("Nopeudet linjoittain")
 
 
 def plot_max_speeds_by_hour(max_speeds, speed_limit, ax):
-    max_speeds = max_speeds.assign(hour=max_speeds.max_speed_time.dt.strftime("%H:00"))
-    plot_max_speeds(max_speeds, speed_limit, ax, "hour")
+    hours = max_speeds.max_speed_time.dt.hour.to_numpy()
+    plot_max_speeds(max_speeds, speed_limit, ax, hours)
+    ax.set_xticklabels([f"{hour:02}:00" for hour in np.unique(hours)], rotation=45)
     ax.set_title("Nopeudet eri kellonaikoina")
     ax.set_ylabel("Nopeus (km/h)")
     ax.set_xlabel("Kellonaika")
 
 
 def plot_statistics(max_speeds, hourly_counts, speed_limit):
-    w, h = mpl.figure.figaspect(9 / 16)
-    fig = plt.figure(figsize=(2.5 * w, 2.5 * h))
+    fig = plt.figure(figsize=FIGURE_SIZE)
     gs = mpl.gridspec.GridSpec(2, 3)
 
     ax = fig.add_subplot(gs[0, 0])
@@ -112,26 +130,44 @@ def plot_statistics(max_speeds, hourly_counts, speed_limit):
 
 
 def get_max_speeds(df, speed_limit):
-    max_speeds = (
-        df.groupby(["route_number", "direction", "operating_day", "start_time"])
-        .speed.agg(["max", "idxmax"])
-        .rename(columns={"max": "max_speed", "idxmax": "max_speed_time"})
+    trips = df.groupby(
+        ["route_number", "direction", "operating_day", "start_time"], observed=True
     )
-    return max_speeds.assign(
-        speeding=max_speeds.max_speed >= speed_limit + constants.SPEEDING_THRESHOLD
+    max_speeds = trips.speed.max().to_frame("max_speed")
+
+    # idxmax is slow, so the time of the maximum speed of each trip is taken
+    # from the first row of the trip with that speed. If the maximum speed of
+    # the trip is null, the first row of the trip is used instead.
+    trip_numbers = trips.ngroup().to_numpy()
+    # Rows with a null trip key are not in any group, so they are skipped
+    in_trip = ~np.isnan(trip_numbers)
+    trip_numbers = trip_numbers[in_trip].astype(np.intp)
+    trip_max_speeds = max_speeds.max_speed.to_numpy()[trip_numbers]
+    speeds = df.speed.to_numpy()[in_trip]
+    is_max = (speeds == trip_max_speeds) | np.isnan(trip_max_speeds)
+    max_rows = np.flatnonzero(is_max)
+    _, first_max_rows = np.unique(trip_numbers[max_rows], return_index=True)
+
+    max_speeds["max_speed_time"] = df.index[in_trip][max_rows[first_max_rows]]
+    max_speeds["speeding"] = (
+        max_speeds.max_speed.to_numpy() >= speed_limit + constants.SPEEDING_THRESHOLD
     )
 
+    # Grouping by categoricals orders the observed trips by appearance
+    return max_speeds.sort_index()
+
 
 def get_hourly_speeding_counts(max_speeds):
-    is_speeding = ~(
-        max_speeds.pivot(
-            columns="speeding", values="speeding", index="max_speed_time"
-        ).isna()
+    # Truncated in UTC, as local hours are ambiguous when daylight saving
+    # time ends, and the time zone has whole hour offsets
+    utc_times = max_speeds.max_speed_time.dt.tz_convert(None).to_numpy()
+    hours = (
+        pd.DatetimeIndex(utc_times.astype("datetime64[h]"), name="hour")
+        .tz_localize("UTC")
+        .tz_convert(constants.TIMEZONE)
     )
     return (
-        is_speeding.astype(int)
-        .reindex(columns=[True, False])
-        .fillna(0)
-        .resample("1H")
-        .sum()
+        pd.crosstab(hours, max_speeds.speeding)
+        .reindex(columns=[True, False], fill_value=0)
+        .asfreq("1H", fill_value=0)
     )
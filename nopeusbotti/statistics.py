@@ -1,5 +1,5 @@
 import logging
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
@@ -7,10 +7,13 @@ import pandas as pd
 
 from nopeusbotti.api import twitter
 from nopeusbotti.data import vehicle_positions
-from nopeusbotti.plots import statistics
+from nopeusbotti.plots import get_plot_file, statistics
 
 logger = logging.getLogger(__name__)
 
+# The columns of the stored position data used for the statistics
+COLUMNS = ["time", "route_number", "direction", "operating_day", "start_time", "speed"]
+
 
 def generate_statistics(
     speed_limit: int,
@@ -39,27 +42,37 @@ def generate_statistics(
     ]
 
     logger.info(f"Reading CSV data from {csv_files}")
-    df = vehicle_positions.read_from_csv(*csv_files)
+    df = vehicle_positions.read_from_csv(*csv_files, columns=COLUMNS)
+
+    plot_file = get_plot_file(plot_directory, store=no_tweets)
+    if no_tweets:
+        logger.info(f"Plotting statistics to {plot_file}")
+        plot_directory.mkdir(parents=True, exist_ok=True)
+    else:
+        # The hashtag requires looking up the account, so do it while plotting
+        credentials = twitter.Credentials.from_environment()
+        executor = ThreadPoolExecutor(max_workers=1)
+        hashtag = executor.submit(get_statistics_hashtag, credentials)
+        executor.shutdown(wait=False)
 
-    plot_filename = plot_directory / (str(uuid.uuid4()) + ".png")
+        logger.info("Plotting statistics")
 
-    logger.info(f"Plotting statistics to {plot_filename}")
-    plot_directory.mkdir(parents=True, exist_ok=True)
     title = statistics.plot_statistics_to_file(
-        df, speed_limit, start_date, end_date, plot_filename
+        df, speed_limit, start_date, end_date, plot_file
     )
 
     if no_tweets:
         return
 
-    logger.info(f"Sending {plot_filename} to Twitter")
+    logger.info("Sending the statistics to Twitter")
+    plot_file.seek(0)
     twitter.send_tweet(
-        f"{title}\n\nAiempia tilastoja voi selata tunnisteella {get_statistics_hashtag()}.",
-        plot_filename,
+        f"{title}\n\nAiempia tilastoja voi selata tunnisteella {hashtag.result()}.",
+        "statistics.png",
+        credentials,
+        media_file=plot_file,
     )
 
-    plot_filename.unlink()
-
 
-def get_statistics_hashtag():
-    return f"#tilastot_{twitter.get_username()}"
+def get_statistics_hashtag(credentials: Optional[twitter.Credentials] = None):
+    return f"#tilastot_{twitter.get_username(credentials)}"